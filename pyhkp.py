@@ -1,9 +1,165 @@
 """This module provides a class to interact with OpenPGP keyservers using HKP."""
 
-from urllib.request import urlopen
-from urllib.parse import urlencode
-from urllib.error import HTTPError
-from datetime import datetime
+from base64 import b64encode
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from http.client import HTTPConnection, HTTPSConnection, RemoteDisconnected
+from queue import LifoQueue, Empty, Full
+from threading import Lock
+from urllib.parse import urlencode, urljoin, urlsplit, urlunsplit, unquote
+from urllib.request import getproxies, proxy_bypass, \
+    __version__ as _urllib_version
+from datetime import datetime, timezone
+from itertools import permutations
+
+# public key algorithm ids as defined in RFC 4880, section 9.1
+_PUBLIC_KEY_ALGORITHMS = {
+    1:  'RSA Encrypt or Sign',
+    2:  'RSA Encrypt-Only',
+    3:  'RSA Sign-Only',
+    16: 'ElGamal Encrypt-Only',
+    17: 'DSA',
+    18: 'Elliptic Curve',
+    19: 'ECDSA',
+    20: 'Formerly ElGamal Encrypt or Sign',
+    21: 'Diffie-Hellman'
+}
+
+# Key id length is limited to:
+# V3 key ids: 32 digits (+ 2 including 0x)
+# V4 key ids: either 8, 16, 32, or 40 digits (+ 2 including 0x)
+_KEY_ID_LENGTHS = frozenset((8, 10, 16, 20, 32, 34, 40, 42))
+
+_EXACT_VALUES = frozenset(('on', 'off'))
+
+# redirects followed for GET requests, like urllib does
+_REDIRECT_STATUSES = frozenset((301, 302, 303, 307, 308))
+_MAX_REDIRECTS = 10
+
+# the keyserver dropped an idle keep-alive connection
+_STALE_CONNECTION_ERRORS = (RemoteDisconnected, BrokenPipeError,
+                            ConnectionResetError)
+
+# same as urlopen
+_USER_AGENT = 'Python-urllib/' + _urllib_version
+
+# number of encoded submit bodies kept for resubmission
+_SUBMIT_BODY_CACHE_SIZE = 8
+
+_UTC = timezone.utc
+_fromtimestamp = datetime.fromtimestamp
+
+
+def _convert_date_if_set(date):
+    """
+    Converts a date string to utc datetime if not empty.
+
+    :param date: date string
+    :type date: bytes
+    :returns: date
+    :rtype: datetime or None
+    """
+    return _fromtimestamp(int(date), _UTC) if date else None
+
+
+class _FlagTable(dict):
+    """
+    Maps the raw flags field of an index record to its revoked, disabled and
+    expired state. Unexpected flag strings are decoded without being stored.
+    """
+    def __missing__(self, flags):
+        return b'r' in flags, b'd' in flags, b'e' in flags
+
+
+# precomputed for every ordering of the flags 'r', 'd' and 'e'
+_FLAGS = _FlagTable()
+_FLAGS.update((flags, _FLAGS[flags]) for flags in
+              (b''.join(chars) for length in range(4)
+               for chars in permutations((b'r', b'd', b'e'), length)))
+
+
+class _Server(object):
+    """
+    Route to a server, either direct or through the proxy urllib would use,
+    as set by the <scheme>_proxy and no_proxy environment variables. Plain
+    http is sent to the proxy with absolute urls, https is tunneled.
+    """
+    __slots__ = ('scheme', 'hostname', 'port', 'base', '_proxy',
+                 '_proxy_headers')
+
+    def __init__(self, scheme, hostname, port):
+        """
+        :param scheme: http or https
+        :type scheme: str
+        :param hostname: server host name
+        :type hostname: str
+        :param port: server port
+        :type port: int
+        """
+        self.scheme = scheme
+        self.hostname = hostname
+        self.port = port
+        self.base = '{0}://{1}:{2}'.format(scheme, hostname, port)
+        self._proxy = None
+        self._proxy_headers = {}
+
+        proxy = getproxies().get(scheme)
+        if proxy and not proxy_bypass(hostname):
+            if '://' not in proxy:
+                proxy = 'http://' + proxy
+            proxy = urlsplit(proxy)
+            self._proxy = (proxy.hostname, proxy.port)
+            if proxy.username is not None:
+                credentials = '{0}:{1}'.format(unquote(proxy.username),
+                                               unquote(proxy.password or ''))
+                self._proxy_headers['Proxy-Authorization'] = 'Basic ' + \
+                    b64encode(credentials.encode()).decode('ascii')
+
+    def same(self, other):
+        """
+        Check if both routes point to the same server.
+
+        :rtype: bool
+        """
+        return (self.scheme, self.hostname, self.port) == \
+            (other.scheme, other.hostname, other.port)
+
+    def connect(self):
+        """
+        Create a connection to the server, it connects on first use.
+
+        :rtype: http.client.HTTPConnection
+        """
+        if self._proxy is None:
+            if self.scheme == 'https':
+                return HTTPSConnection(self.hostname, self.port)
+            return HTTPConnection(self.hostname, self.port)
+
+        if self.scheme == 'https':
+            connection = HTTPSConnection(*self._proxy)
+            connection.set_tunnel(self.hostname, self.port,
+                                  self._proxy_headers)
+            return connection
+        return HTTPConnection(*self._proxy)
+
+    def send(self, connection, method, url, body, headers):
+        """
+        Send a request on a connection created by :func:`connect`.
+
+        :param url: request path including query string
+        :type url: str
+        :returns: response, not yet read
+        :rtype: http.client.HTTPResponse
+        """
+        request_headers = {'User-Agent': _USER_AGENT}
+        if self._proxy is not None and self.scheme != 'https':
+            url = self.base + url
+            request_headers.update(self._proxy_headers)
+        request_headers.update(headers)
+
+        connection.request(method, url, body, request_headers)
+        return connection.getresponse()
 
 
 class HKP(object):
@@ -12,18 +168,171 @@ class HKP(object):
     (HKP), as defined in
     `RFC draft-shaw-openpgp-hkp-00 <http://tools.ietf.org/html/draft-shaw-openpgp-pyhkp-00#section-3.2.1>`_.
     """
-    def __init__(self, host, port=11371):
+    __slots__ = ('host', 'port', 'lookup_path', 'submit_path', 'scheme',
+                 'hostname', '_server', '_pool', '_retrieve_cache',
+                 '_retrieve_cache_max', '_submit_body_cache', '_cache_lock')
+
+    def __init__(self, host, port=11371, maxsize=16, cache_size=128):
         """
+        Proxies are taken from the environment like urllib does, see
+        :func:`urllib.request.getproxies`.
+
         :param host: http://-URL to keyserver, without ending backslash
         :type host: str
         :param port: port, default ist 11371
         :type port: int
+        :param maxsize: number of idle keep-alive connections kept for reuse
+        :type maxsize: int
+        :param cache_size: number of retrieved keys kept in memory, 0 \
+        disables caching
+        :type cache_size: int
         """
         self.host = host
         self.port = port
         self.lookup_path = '/pks/lookup'
         self.submit_path = '/pks/add'
 
+        split_host = urlsplit(host)
+        self.scheme = split_host.scheme
+        self.hostname = split_host.hostname
+        self._server = _Server(self.scheme, self.hostname, port)
+        self._pool = LifoQueue(maxsize)
+        self._retrieve_cache = OrderedDict()
+        self._retrieve_cache_max = cache_size
+        self._submit_body_cache = OrderedDict()
+        self._cache_lock = Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Close all idle pooled connections. The instance stays usable, new
+        connections are opened as needed.
+        """
+        while True:
+            try:
+                connection = self._pool.get_nowait()
+            except Empty:
+                return
+            connection.close()
+
+    def _send_pooled(self, method, url, body, headers):
+        """
+        Send a request to the keyserver over a pooled keep-alive connection.
+        Only GET requests take an idle connection and are resent once on a
+        fresh one if the keyserver had dropped it. Other requests are not
+        idempotent and always get a fresh connection.
+
+        :returns: connection and response, not yet read
+        :rtype: tuple(http.client.HTTPConnection, http.client.HTTPResponse)
+        """
+        server = self._server
+        connection = None
+        if method == 'GET':
+            try:
+                connection = self._pool.get_nowait()
+            except Empty:
+                pass
+
+        if connection is not None:
+            try:
+                return connection, server.send(connection, method, url, body,
+                                               headers)
+            except _STALE_CONNECTION_ERRORS:
+                connection.close()
+            except BaseException:
+                connection.close()
+                raise
+
+        connection = server.connect()
+        try:
+            return connection, server.send(connection, method, url, body,
+                                           headers)
+        except BaseException:
+            connection.close()
+            raise
+
+    def _release(self, connection, response, pooled):
+        """
+        Return a connection to the pool if its response has been read
+        completely and the server keeps it open, otherwise close it.
+        """
+        if not pooled or response.will_close or not response.isclosed():
+            connection.close()
+            return
+        try:
+            self._pool.put_nowait(connection)
+        except Full:
+            connection.close()
+
+    @contextmanager
+    def _request(self, method, url, body=None, headers=None):
+        """
+        Send a request to the keyserver, see :func:`_send_pooled`. Redirects
+        of GET requests are followed, over the pool if they point to the
+        same keyserver. The connection goes back to the pool once the
+        response has been read completely, otherwise it is closed.
+
+        :param method: http method
+        :type method: str
+        :param url: request path including query string
+        :type url: str
+        :param body: request body
+        :type body: bytes or None
+        :param headers: request headers
+        :type headers: dict or None
+        :returns: context manager yielding the response
+        :rtype: http.client.HTTPResponse
+        """
+        if headers is None:
+            headers = {}
+
+        connection, response = self._send_pooled(method, url, body, headers)
+        server = self._server
+        pooled = True
+
+        for _ in range(_MAX_REDIRECTS):
+            location = response.getheader('Location')
+            if method != 'GET' or location is None or \
+                    response.status not in _REDIRECT_STATUSES:
+                break
+
+            response.read()
+            self._release(connection, response, pooled)
+
+            target = urlsplit(urljoin(server.base + url, location))
+            if target.scheme == 'https':
+                port = target.port or 443
+            else:
+                port = target.port or 80
+            url = urlunsplit(('', '', target.path or '/', target.query, ''))
+            server = _Server(target.scheme, target.hostname, port)
+
+            pooled = server.same(self._server)
+            if pooled:
+                connection, response = self._send_pooled(method, url, body,
+                                                         headers)
+            else:
+                connection = server.connect()
+                try:
+                    response = server.send(connection, method, url, body,
+                                           headers)
+                except BaseException:
+                    connection.close()
+                    raise
+
+        try:
+            yield response
+        except BaseException:
+            connection.close()
+            raise
+
+        self._release(connection, response, pooled)
+
     @staticmethod
     def lookup_pubkey_algorithm(alg):
         """
@@ -34,93 +343,79 @@ class HKP(object):
         :returns: algorithm name
         :rtype: str
         """
-        public_key_algorithms = {
-            1:  'RSA Encrypt or Sign',
-            2:  'RSA Encrypt-Only',
-            3:  'RSA Sign-Only',
-            16: 'ElGamal Encrypt-Only',
-            17: 'DSA',
-            18: 'Elliptic Curve',
-            19: 'ECDSA',
-            20: 'Formerly ElGamal Encrypt or Sign',
-            21: 'Diffie-Hellman'
-        }
         if 100 <= alg <= 110:
             return 'Private/Experimental algorithm'
-        return public_key_algorithms.get(alg, 'Unknown')
+        return _PUBLIC_KEY_ALGORITHMS.get(alg, 'Unknown')
 
     def _parse_index(self, mr_keyserver_answer):
         """
         Will parse the machine readable index retrieved with the 'index' operation and returns a list of dicts,
         see :func:`search`.
 
-        :param mr_keyserver_answer: machine readable answer from keyserver
-        :type mr_keyserver_answer: str
+        :param mr_keyserver_answer: raw machine readable answer from \
+        keyserver, either as a whole or as an iterable of its lines
+        :type mr_keyserver_answer: bytes or iterable(bytes)
         :returns: parsed keys
         :rtype: dict
         """
-        def convert_date_if_set(date):
-            """
-            Converts a date string to utc datetime if not None.
-
-            :param date: date string
-            :type date: str
-            :returns: date
-            :rtype: datetime
-            """
-            if date != '':
-                return datetime.utcfromtimestamp(int(date))
+        # local names avoid global lookups inside the loop
+        to_int = int
+        convert_date_if_set = _convert_date_if_set
+        lookup_pubkey_algorithm = self.lookup_pubkey_algorithm
+        flag_table = _FLAGS
 
         keys = []
-
-        mr_keyserver_answer = mr_keyserver_answer.replace('\n', '').replace('\r', '')
-
-        # first split by pub: to get the keys and their uids
-        keys_split = mr_keyserver_answer.split('pub')
-
-        for key_str in keys_split:
-            # skip info:<version>:<count> line, we don't need it
-            if key_str.startswith('info'):
-                continue
-
-            # will hold the return values
-            key_dict = {
-                'primary_key': {},
-                'user_ids':  []
-            }
-
-            key_str = key_str.split('uid:')
-            for value in key_str:
-                value = value.split(':')
-                if len(value) > 4:
-                    #pub:<keyid>:<algo>:<keylen>:<creationdate>:
-                    # <expirationdate>:<flags>
-                    key_dict['primary_key'] = {
-                        'key_id':       value[1],
-                        'algorithm_id': int(value[2]),
-                        'algorithm':    self.lookup_pubkey_algorithm(
-                            int(value[2])),
-                        'key_length':   int(value[3]),
+        key_dict = None
+
+        if isinstance(mr_keyserver_answer, bytes):
+            # empty or info only answer, pub records follow the optional
+            # info:<version>:<count> line right away
+            if b'pub:' not in mr_keyserver_answer[:256]:
+                return []
+            lines = mr_keyserver_answer.splitlines()
+        else:
+            # streams only break at \n, split again for bare \r endings
+            lines = (record for line in mr_keyserver_answer
+                     for record in line.splitlines())
+
+        # one pass over the records, info:<version>:<count> and unknown
+        # lines are skipped. The answer is ASCII, so only the fields
+        # returned as text are decoded
+        for line in lines:
+            if line.startswith(b'pub:'):
+                #pub:<keyid>:<algo>:<keylen>:<creationdate>:
+                # <expirationdate>:<flags>
+                value = line.split(b':', 7)
+                algorithm_id = to_int(value[2])
+                revoked, disabled, expired = flag_table[value[6]]
+                key_dict = {
+                    'primary_key': {
+                        'key_id':       value[1].decode(),
+                        'algorithm_id': algorithm_id,
+                        'algorithm':    lookup_pubkey_algorithm(algorithm_id),
+                        'key_length':   to_int(value[3]),
                         'creation':     convert_date_if_set(value[4]),
                         'expiration':   convert_date_if_set(value[5]),
-                        'revoked':      'r' in value[6],
-                        'disabled':     'd' in value[6],
-                        'expired':      'e' in value[6]
-                    }
-                else:
-                    # uid:<escaped uid string>:<creationdate>:
-                    # <expirationdate>:<flags>
-                    # uid: has been stripped
-                    uid = {
-                        'user_id':    value[0],
-                        'creation':   convert_date_if_set(value[1]),
-                        'expiration': convert_date_if_set(value[2]),
-                        'revoked':    'r' in value[3],
-                        'disabled':   'd' in value[3],
-                        'expired':    'e' in value[3]
-                    }
-                    key_dict['user_ids'].append(uid)
-            keys.append(key_dict)
+                        'revoked':      revoked,
+                        'disabled':     disabled,
+                        'expired':      expired
+                    },
+                    'user_ids': []
+                }
+                keys.append(key_dict)
+            elif line.startswith(b'uid:') and key_dict is not None:
+                # uid:<escaped uid string>:<creationdate>:
+                # <expirationdate>:<flags>
+                value = line.split(b':', 5)
+                revoked, disabled, expired = flag_table[value[4]]
+                key_dict['user_ids'].append({
+                    'user_id':    value[1].decode('utf-8', 'replace'),
+                    'creation':   convert_date_if_set(value[2]),
+                    'expiration': convert_date_if_set(value[3]),
+                    'revoked':    revoked,
+                    'disabled':   disabled,
+                    'expired':    expired
+                })
         return keys
 
     @staticmethod
@@ -134,20 +429,36 @@ class HKP(object):
         :returns: comma separated list of options
         :rtype: str
         """
-        ops = set()
-        ops.add('mr')
+        if not options or options[0] is None:
+            return 'mr'
+
+        # only a handful of options, a list keeps them unique and ordered
+        ops = ['mr']
+        for option in options:
+            if (option == 'nm' or option.startswith('x-')) and \
+                    option not in ops:
+                ops.append(option)
 
-        if options is not None and options[0] is not None:
-            for option in options:
-                if option == 'nm' or option.startswith('x-'):
-                    ops.add(option)
+        return ','.join(ops)
 
-        return ','.join(op for op in ops)
+    @staticmethod
+    def _check_key_id(key_id):
+        """
+        Check if a key id is given and of a valid length.
+
+        :param key_id: key id
+        :type key_id: str
+        :raises ValueError: on missing or invalid key id
+        """
+        if key_id is None or len(key_id) not in _KEY_ID_LENGTHS:
+            raise ValueError('no or invalid key id')
 
     def retrieve(self, key_id, options=(None,)):
         """
         Retrieve a public key from the keyserver by a given key id.
         Retrieval by query is not supported, since queries may be ambiguous.
+        Successfully retrieved keys are cached, least recently used first
+        out.
 
         :param key_id: key id to get key from
         :type key_id: str
@@ -157,29 +468,80 @@ class HKP(object):
         :returns: pgp public key, or None if not available/error
         :rtype: str or None
         """
-        if key_id is None or len(key_id) not in (8, 10, 16, 20, 32, 34, 40,
-                                                 42):
-            # Key id length is limited to:
-            # V3 key ids: 32 digits (+ 2 including 0x)
-            # V4 key ids: either 8, 16, 32, or 40 digits (+ 2 including 0x)
-            raise ValueError('no or invalid key id')
+        self._check_key_id(key_id)
 
         if not key_id.startswith('0x'):
-            key_id = '{0}{1}'.format('0x', key_id)
+            key_id = '0x' + key_id
+
+        options = self._parse_options(options)
+        cache_key = (key_id, options)
+        with self._cache_lock:
+            key = self._retrieve_cache.get(cache_key)
+            if key is not None:
+                self._retrieve_cache.move_to_end(cache_key)
+        if key is not None:
+            return key
 
         params = {
             'search': key_id,
             'op': 'get',
-            'options': self._parse_options(options)
+            'options': options
         }
 
-        url = '{0}:{1}{2}?{3}'.format(self.host, self.port,
-                                      self.lookup_path, urlencode(params))
-        try:
-            response = urlopen(url)
-            return response.read().decode().rstrip()
-        except HTTPError:
+        url = self.lookup_path + '?' + urlencode(params)
+        with self._request('GET', url) as response:
+            data = response.read()
+        if response.status != 200:
+            # errors are not cached, they may be transient
             return None
+        key = data.decode().rstrip()
+
+        if self._retrieve_cache_max > 0:
+            with self._cache_lock:
+                self._retrieve_cache[cache_key] = key
+                if len(self._retrieve_cache) > self._retrieve_cache_max:
+                    self._retrieve_cache.popitem(last=False)
+        return key
+
+    def retrieve_many(self, key_ids, options=(None,), workers=8):
+        """
+        Retrieve several public keys concurrently, see :func:`retrieve`.
+        All key ids are checked before any request is sent. Stopping the
+        iteration early cancels the requests not yet started.
+        Keep workers at most the pool size given to the constructor,
+        otherwise surplus connections are opened and closed per request.
+
+        :param key_ids: key ids to get keys from
+        :type key_ids: iterable(str)
+        :param options: nonstandard option starting with 'x-'
+        :type options: tuple(str)
+        :param workers: number of concurrent requests
+        :type workers: int
+        :returns: key id and pgp public key (or None), in completion order
+        :rtype: generator of tuple(str, str or None)
+        :raises ValueError: if any key id is missing or invalid
+        """
+        key_ids = list(key_ids)
+        for key_id in key_ids:
+            self._check_key_id(key_id)
+        return self._retrieve_many(key_ids, options, workers)
+
+    def _retrieve_many(self, key_ids, options, workers):
+        """
+        Generator behind :func:`retrieve_many`, key ids are already checked.
+        If the caller stops early or a retrieval fails, requests not yet
+        started are cancelled instead of waited for.
+        """
+        executor = ThreadPoolExecutor(max_workers=workers)
+        futures = {executor.submit(self.retrieve, key_id, options): key_id
+                   for key_id in key_ids}
+        try:
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
 
     def search(self, query, operation='index', exact='off', options=(None,),
                other_variables=(None,)):
@@ -231,22 +593,25 @@ class HKP(object):
             'search': query,
             'op': operation,
             'options': self._parse_options(options),
-            'exact': exact if exact in ('on', 'off') else 'off'
+            'exact': exact if exact in _EXACT_VALUES else 'off'
         }
 
-        if other_variables[0] is not None:
-            for var in other_variables:
-                if var[0].startswith('x-'):
-                    params[var[0]] = var[1]
-
-        url = '{0}:{1}{2}?{3}'.format(self.host, self.port,
-                                      self.lookup_path, urlencode(params))
-
-        try:
-            response = urlopen(url)
-            return self._parse_index(response.read().decode())
-        except HTTPError:
-            return None
+        if other_variables and other_variables[0] is not None:
+            startswith = str.startswith
+            for name, value in other_variables:
+                if startswith(name, 'x-'):
+                    params[name] = value
+
+        url = self.lookup_path + '?' + urlencode(params)
+        with self._request('GET', url) as response:
+            if response.status != 200:
+                return None
+            # parse while reading instead of buffering the whole answer
+            keys = self._parse_index(response)
+            # reading lines does not mark the response as complete, an
+            # empty read does so the connection can be reused
+            response.read()
+        return keys
 
     def submit(self, keys, options=(None,)):
         """
@@ -263,14 +628,27 @@ class HKP(object):
         if keys is None:
             raise ValueError('no key(s) given')
 
-        params = {
-            'keytext': keys,
-            'options': self._parse_options(options)
-        }
-
-        url = '{0}:{1}{2}'.format(self.host, self.port, self.submit_path)
-        try:
-            req = urlopen(url, urlencode(params).encode())
-            return req.getcode()
-        except HTTPError as error:
-            return error.getcode()
\ No newline at end of file
+        options = self._parse_options(options)
+        cache_key = (keys, options)
+        with self._cache_lock:
+            body = self._submit_body_cache.get(cache_key)
+            if body is not None:
+                self._submit_body_cache.move_to_end(cache_key)
+
+        if body is None:
+            params = {
+                'keytext': keys,
+                'options': options
+            }
+            # percent-encoding the key text is costly, keep the last few
+            body = urlencode(params).encode()
+            with self._cache_lock:
+                self._submit_body_cache[cache_key] = body
+                if len(self._submit_body_cache) > _SUBMIT_BODY_CACHE_SIZE:
+                    self._submit_body_cache.popitem(last=False)
+
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        with self._request('POST', self.submit_path, body,
+                           headers) as response:
+            response.read()
+        return response.status
\ No newline at end of file
@@ -1,8 +1,15 @@
 from unittest import TestCase, main, skip
-from re import compile, DOTALL
+from unittest.mock import patch
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from threading import Thread
+from time import sleep, time
+from urllib.parse import urlsplit, parse_qs
 from pyhkp import HKP
 
-# These tests need an internet connection.
+# TestHKP needs an internet connection, TestHKPConnection runs against a
+# local keyserver.
 
 # Test keyserver
 KEYSERVER = 'http://pgp.mit.edu'
@@ -15,6 +22,74 @@ KEY_ID_0x = '0x' + KEY_ID
 KEY_UID = 'Debian Archive Automatic Signing Key (2006) <ftpmaster@debian.org>'
 KEY_UID_NAME = 'Debian Archive Automatic Signing Key (2006)'
 
+# Machine readable index as returned by the 'index' operation
+MR_INDEX = (b'info:1:2\r\n'
+            b'pub:2D230C5F:17:1024:1136286739::\r\n'
+            b'uid:' + KEY_UID.encode() + b':1136286739::\r\n'
+            b'pub:ABCDEF12:1:4096:1136286739:1236286739:re\r\n'
+            b'uid:pub%3A user:1136286739::d\r\n'
+            b'uid:Second:::\r\n')
+
+
+class LocalKeyserver(BaseHTTPRequestHandler):
+    """
+    Minimal keyserver for the connection tests. Requests are recorded in the
+    server's requests list. Lookup paths may be prefixed with:
+
+    * /redirect: 302 to the same path without the prefix
+    * /moved: 301 without location
+    * /drop: answer, then close the connection without announcing it
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def answer(self, status, body=b'', location=None):
+        """
+        Send a response.
+        """
+        self.send_response(status)
+        if location is not None:
+            self.send_header('Location', location)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        """
+        Answer lookups.
+        """
+        self.server.requests.append((self.client_address, self.command,
+                                     self.path, None))
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+
+        if url.path.startswith('/redirect/'):
+            self.answer(302, location=self.path[len('/redirect'):])
+        elif url.path.startswith('/moved/'):
+            self.answer(301, b'<html>moved</html>')
+        elif query['op'] == ['index']:
+            self.answer(200, MR_INDEX)
+        elif query['search'][0].upper() in ('0X' + KEY_ID,
+                                            '0X' + KEY_FINGERPRINT):
+            with open('testdata/debian.asc', 'rb') as stored_key:
+                self.answer(200, stored_key.read())
+        else:
+            self.answer(404, b'not found')
+
+        if url.path.startswith('/drop/'):
+            self.close_connection = True
+
+    def do_POST(self):
+        """
+        Accept submissions.
+        """
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append((self.client_address, self.command,
+                                     self.path, body))
+        self.answer(200)
+
 
 class TestHKP(TestCase):
     """
@@ -29,12 +104,13 @@ class TestHKP(TestCase):
         :returns: string index of key data beginning or 0
         :rtype: int
         """
-        idx = compile('-----BEGIN PGP (?!SIGNED)(.*)\n\n', flags=DOTALL).\
-            search(key)
-        if idx is not None:
-            return idx.end()
-        else:
+        begin = key.find('-----BEGIN PGP ')
+        if begin == -1 or key.startswith('SIGNED', begin + 15):
+            return 0
+        end = key.find('\n\n', begin)
+        if end == -1:
             return 0
+        return end + 2
 
     def setUp(self):
         """
@@ -66,11 +142,83 @@ class TestHKP(TestCase):
         Test parsing options.
         """
         self.assertEqual(self.hkp._parse_options(None), 'mr')
+        self.assertEqual(self.hkp._parse_options((None,)), 'mr')
+        self.assertEqual(self.hkp._parse_options(()), 'mr')
+        self.assertEqual(self.hkp._parse_options(('nm', 'x-d', 'nm')),
+                         'mr,nm,x-d')
         self.assertTrue('mr' and ',' and 'x-d' in
                         self.hkp._parse_options(('test', 'x-d')))
         self.assertTrue('mr' and ',' and 'x-d' and 'nm' in
                         self.hkp._parse_options(('x-d', 'test', 'nm', 'ab')))
 
+    def test_parse_index(self):
+        """
+        Test parsing a machine readable index.
+        """
+        keys = self.hkp._parse_index(MR_INDEX)
+        self.assertEqual(len(keys), 2)
+
+        self.assertEqual(keys[0]['primary_key'], {
+            'key_id': KEY_ID,
+            'algorithm_id': 17,
+            'algorithm': 'DSA',
+            'key_length': 1024,
+            'creation': datetime(2006, 1, 3, 11, 12, 19,
+                                 tzinfo=timezone.utc),
+            'expiration': None,
+            'revoked': False,
+            'disabled': False,
+            'expired': False
+        })
+        self.assertEqual(len(keys[0]['user_ids']), 1)
+        self.assertEqual(keys[0]['user_ids'][0]['user_id'], KEY_UID)
+
+        primary_key = keys[1]['primary_key']
+        self.assertEqual(primary_key['expiration'],
+                         datetime(2009, 3, 5, 20, 58, 59,
+                                  tzinfo=timezone.utc))
+        self.assertTrue(primary_key['revoked'])
+        self.assertTrue(primary_key['expired'])
+        self.assertFalse(primary_key['disabled'])
+
+        user_ids = keys[1]['user_ids']
+        self.assertEqual([uid['user_id'] for uid in user_ids],
+                         ['pub%3A user', 'Second'])
+        self.assertTrue(user_ids[0]['disabled'])
+        self.assertIsNone(user_ids[1]['creation'])
+
+        # lines read from a stream keep their terminators
+        self.assertEqual(
+            self.hkp._parse_index(BytesIO(MR_INDEX)), keys)
+
+        # records may be terminated by \n, \r\n or a bare \r
+        self.assertEqual(
+            self.hkp._parse_index(MR_INDEX.replace(b'\r', b'')), keys)
+        self.assertEqual(
+            self.hkp._parse_index(MR_INDEX.replace(b'\n', b'')), keys)
+        self.assertEqual(
+            self.hkp._parse_index(BytesIO(MR_INDEX.replace(b'\r', b''))),
+            keys)
+        self.assertEqual(
+            self.hkp._parse_index(BytesIO(MR_INDEX.replace(b'\n', b''))),
+            keys)
+
+        # fields beyond the flags are ignored
+        keys = self.hkp._parse_index(b'pub:AB:1:2048:1::r:extra\n'
+                                     b'uid:Name:1:::ed\n')
+        self.assertEqual(
+            [keys[0]['primary_key'][flag]
+             for flag in ('revoked', 'disabled', 'expired')],
+            [True, False, False])
+        self.assertEqual(
+            [keys[0]['user_ids'][0][flag]
+             for flag in ('revoked', 'disabled', 'expired')],
+            [False, False, False])
+
+        self.assertEqual(self.hkp._parse_index(b'info:1:0\n'), [])
+        self.assertEqual(self.hkp._parse_index(BytesIO(b'info:1:0\n')), [])
+        self.assertEqual(self.hkp._parse_index(b''), [])
+
     def test_retrieve(self):
         """
         Test key retrieval.
@@ -99,6 +247,63 @@ class TestHKP(TestCase):
             retrieved = retrieved[self.strip_pgp_ascii_header(retrieved):]
             self.assertEqual(retrieved, key)
 
+    def test_retrieve_cache_hit(self):
+        """
+        Test that cached keys are returned without asking the keyserver.
+        """
+        self.hkp._retrieve_cache[(KEY_ID_0x, 'mr')] = 'cached key'
+        self.assertEqual(self.hkp.retrieve(KEY_ID), 'cached key')
+        self.assertEqual(self.hkp.retrieve(KEY_ID_0x), 'cached key')
+
+    def test_retrieve_cache(self):
+        """
+        Test caching of retrieved keys.
+        """
+        # failures are not cached
+        self.assertIsNone(self.hkp.retrieve('ABCDEFGH'))
+        self.assertEqual(len(self.hkp._retrieve_cache), 0)
+
+        key = self.hkp.retrieve(KEY_ID_0x)
+        self.assertEqual(len(self.hkp._retrieve_cache), 1)
+        self.assertIs(self.hkp.retrieve(KEY_ID), key)
+        self.assertEqual(len(self.hkp._retrieve_cache), 1)
+
+        # least recently used key is evicted first
+        hkp = HKP(KEYSERVER, PORT, cache_size=2)
+        hkp.retrieve(KEY_ID_0x)
+        hkp.retrieve(KEY_FINGERPRINT)
+        hkp.retrieve(KEY_ID_0x)
+        hkp.retrieve(KEY_ID_0x, options=('x-test',))
+        self.assertEqual(list(hkp._retrieve_cache),
+                         [(KEY_ID_0x, 'mr'), (KEY_ID_0x, 'mr,x-test')])
+
+        hkp = HKP(KEYSERVER, PORT, cache_size=0)
+        self.assertIsNotNone(hkp.retrieve(KEY_ID_0x))
+        self.assertEqual(len(hkp._retrieve_cache), 0)
+
+    def test_retrieve_many(self):
+        """
+        Test concurrent key retrieval.
+        """
+        # checked before anything is requested
+        with self.assertRaisesRegex(ValueError, 'no or invalid key id'):
+            self.hkp.retrieve_many([KEY_ID_0x, ''])
+
+        key_ids = [KEY_ID, KEY_ID_0x, KEY_FINGERPRINT, 'ABCDEFGH']
+        results = list(self.hkp.retrieve_many(key_ids, workers=4))
+        self.assertEqual(sorted(key_id for key_id, _ in results),
+                         sorted(key_ids))
+
+        with open('testdata/debian.asc', 'r') as stored_key:
+            key = stored_key.read()
+            key = key[self.strip_pgp_ascii_header(key):]
+        for key_id, retrieved in results:
+            if key_id == 'ABCDEFGH':
+                self.assertIsNone(retrieved)
+            else:
+                retrieved = retrieved[self.strip_pgp_ascii_header(retrieved):]
+                self.assertEqual(retrieved, key)
+
     def test_search(self):
         """
         Test searching on a keyserver.
@@ -122,5 +327,201 @@ class TestHKP(TestCase):
             self.assertEqual(500, self.hkp.submit(key[:-39]))  # strip crc
 
 
+class TestHKPConnection(TestCase):
+    """
+    Unit tests for connection handling of HKP class against a local keyserver.
+    """
+    @classmethod
+    def setUpClass(cls):
+        """
+        Start local keyserver.
+        """
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), LocalKeyserver)
+        cls.server.requests = []
+        Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        """
+        Stop local keyserver.
+        """
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        """
+        Setup object instance, bypassing any proxy from the environment.
+        """
+        self.environ = patch.dict('os.environ', {'no_proxy': '*'})
+        self.environ.start()
+        self.server.requests.clear()
+        self.hkp = HKP('http://127.0.0.1', self.server.server_address[1])
+
+    def tearDown(self):
+        """
+        Close idle connections.
+        """
+        self.hkp.close()
+        self.environ.stop()
+
+    def clients(self):
+        """
+        :returns: client addresses the keyserver got requests from
+        :rtype: set
+        """
+        return set(request[0] for request in self.server.requests)
+
+    def test_connection_reuse(self):
+        """
+        Test that requests share one keep-alive connection.
+        """
+        self.assertIsNotNone(self.hkp.retrieve(KEY_ID_0x))
+        self.assertIsNone(self.hkp.retrieve('ABCDEFGH'))
+        self.assertEqual(len(self.hkp.search(KEY_ID_0x)), 2)
+        self.assertIsNotNone(self.hkp.retrieve(KEY_FINGERPRINT))
+
+        self.assertEqual(len(self.server.requests), 4)
+        self.assertEqual(len(self.clients()), 1)
+        self.assertEqual(self.hkp._pool.qsize(), 1)
+
+    def test_redirect(self):
+        """
+        Test that redirects to the same keyserver are followed over the pool.
+        """
+        self.hkp.lookup_path = '/redirect/pks/lookup'
+        key = self.hkp.retrieve(KEY_ID_0x)
+        with open('testdata/debian.asc', 'r') as stored_key:
+            self.assertEqual(key, stored_key.read().rstrip())
+
+        self.assertEqual([urlsplit(request[2]).path
+                          for request in self.server.requests],
+                         ['/redirect/pks/lookup', '/pks/lookup'])
+        self.assertEqual(len(self.clients()), 1)
+
+    def test_non_200_not_cached(self):
+        """
+        Test that answers other than 200 are failures and not cached.
+        """
+        self.hkp.lookup_path = '/moved/pks/lookup'
+        self.assertIsNone(self.hkp.retrieve(KEY_ID_0x))
+        self.assertIsNone(self.hkp.search(KEY_ID_0x))
+        self.assertEqual(len(self.hkp._retrieve_cache), 0)
+
+        self.hkp.lookup_path = '/pks/lookup'
+        self.assertIsNone(self.hkp.retrieve('ABCDEFGH'))
+        self.assertEqual(len(self.hkp._retrieve_cache), 0)
+
+    def test_dropped_connection(self):
+        """
+        Test that a GET is resent once if the idle connection was dropped.
+        """
+        self.hkp.lookup_path = '/drop/pks/lookup'
+        self.assertIsNotNone(self.hkp.retrieve(KEY_ID_0x))
+        self.assertEqual(self.hkp._pool.qsize(), 1)
+        self.assertIsNotNone(self.hkp.retrieve(KEY_FINGERPRINT))
+        self.assertEqual(len(self.clients()), 2)
+
+    def test_submit_fresh_connection(self):
+        """
+        Test that submissions don't take idle connections.
+        """
+        self.hkp.retrieve(KEY_ID_0x)
+        self.assertEqual(self.hkp.submit('key'), 200)
+        self.assertEqual(len(self.clients()), 2)
+
+    def test_retrieve_many_stop_early(self):
+        """
+        Test that stopping retrieve_many early cancels pending requests.
+        """
+        retrieved = []
+
+        class SlowHKP(HKP):
+            def retrieve(self, key_id, options=(None,)):
+                retrieved.append(key_id)
+                sleep(0.2)
+                return 'key'
+
+        hkp = SlowHKP('http://127.0.0.1', self.server.server_address[1])
+        key_ids = ['{0:08X}'.format(i) for i in range(40)]
+        start = time()
+        for key_id, key in hkp.retrieve_many(key_ids, workers=4):
+            self.assertEqual(key, 'key')
+            break
+        self.assertLess(time() - start, 1)
+        sleep(0.3)
+        self.assertLessEqual(len(retrieved), 8)
+
+        class FailingHKP(HKP):
+            def retrieve(self, key_id, options=(None,)):
+                retrieved.append(key_id)
+                if key_id == key_ids[0]:
+                    raise OSError('failed')
+                sleep(0.2)
+                return 'key'
+
+        retrieved.clear()
+        hkp = FailingHKP('http://127.0.0.1', self.server.server_address[1])
+        start = time()
+        with self.assertRaisesRegex(OSError, 'failed'):
+            list(hkp.retrieve_many(key_ids, workers=4))
+        self.assertLess(time() - start, 1)
+        sleep(0.3)
+        self.assertLessEqual(len(retrieved), 8)
+
+    def test_submit_body_cache(self):
+        """
+        Test caching of encoded submit bodies.
+        """
+        self.assertEqual(self.hkp.submit('key'), 200)
+        body = self.hkp._submit_body_cache[('key', 'mr')]
+        self.assertEqual(self.hkp.submit('key'), 200)
+        self.assertIs(self.hkp._submit_body_cache[('key', 'mr')], body)
+        self.assertEqual([request[3] for request in self.server.requests],
+                         [body, body])
+
+        # other options are kept apart
+        self.assertEqual(self.hkp.submit('key', options=('nm',)), 200)
+        self.assertEqual(list(self.hkp._submit_body_cache),
+                         [('key', 'mr'), ('key', 'mr,nm')])
+        self.assertIn(b'options=mr%2Cnm', self.server.requests[-1][3])
+
+        # least recently used body is evicted after 8
+        self.hkp.submit('key')
+        for i in range(7):
+            self.hkp.submit('key{0}'.format(i))
+        self.assertEqual(len(self.hkp._submit_body_cache), 8)
+        self.assertNotIn(('key', 'mr,nm'), self.hkp._submit_body_cache)
+        self.assertEqual(next(iter(self.hkp._submit_body_cache)),
+                         ('key', 'mr'))
+
+    def test_close(self):
+        """
+        Test closing idle connections.
+        """
+        self.hkp.retrieve(KEY_ID_0x)
+        self.assertEqual(self.hkp._pool.qsize(), 1)
+        self.hkp.close()
+        self.assertEqual(self.hkp._pool.qsize(), 0)
+
+        with HKP('http://127.0.0.1', self.server.server_address[1]) as hkp:
+            self.assertIsNotNone(hkp.retrieve(KEY_ID_0x))
+            self.assertEqual(hkp._pool.qsize(), 1)
+        self.assertEqual(hkp._pool.qsize(), 0)
+
+    def test_proxy(self):
+        """
+        Test that the http proxy from the environment is used.
+        """
+        proxy = 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+        with patch.dict('os.environ', {'http_proxy': proxy, 'no_proxy': ''}):
+            with HKP('http://keyserver.invalid') as hkp:
+                self.assertIsNotNone(hkp.retrieve(KEY_ID_0x))
+
+        self.assertEqual(
+            self.server.requests[0][2],
+            'http://keyserver.invalid:11371/pks/lookup?search=' +
+            KEY_ID_0x + '&op=get&options=mr')
+
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()